@@ -1,9 +1,32 @@
 
+import os
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 import pandas as pd
 import numpy as np
-from typing import Dict
+from typing import Dict, Optional
 
-def format_columns(df: pd.DataFrame, column_renames: Dict[str, str] ) -> pd.DataFrame:
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    STRING_DTYPE = 'string[pyarrow]' # Arrow backed strings, .str methods run on Arrow compute kernels
+    PYARROW_VERSION = pa.__version__
+except ImportError:
+    STRING_DTYPE = 'string'
+    PYARROW_VERSION = None
+
+PARALLEL_MIN_ROWS = 1_000_000 # string columns with at least this many rows are replaced in parallel chunks
+CARDINALITY_SAMPLE_ROWS = 10_000 # rows sampled to estimate whether a column has low cardinality
+# cached results are only reused by the same code and library versions
+CACHE_VERSION = [hashlib.blake2b(Path(__file__).read_bytes(), digest_size = 16).hexdigest(),
+                 pd.__version__, PYARROW_VERSION]
+
+def format_columns(df: pd.DataFrame, column_renames: Dict[str, str], copy: bool = True) -> pd.DataFrame:
     '''
     This function takes a DataFrame and 
     (1) formats column names to lower case and removes white spaces and
@@ -12,38 +35,56 @@ def format_columns(df: pd.DataFrame, column_renames: Dict[str, str] ) -> pd.Data
     Inputs:
     df: input DataFrame
     column_renames: Dictionary with column renaming
+    copy: if False, df is modified in place instead of copied
     
     Outputs:
     formatted DataFrame
     '''
-    df_formatted = df.copy()
-    df_formatted.columns = [col.lower().replace(' ','_') for col in df.columns] # remove white spaces & lower cased
-    df_formatted.rename(columns = column_renames, inplace = True) # rename columns according to dictionary
+    df_formatted = df.copy() if copy else df
+    if not all(col == col.lower() and ' ' not in col for col in df.columns): # skip already formatted columns
+        df_formatted.columns = df.columns.str.lower().str.replace(' ', '_', regex = False) # remove white spaces & lower cased
+    if column_renames and not df_formatted.columns.intersection(list(column_renames)).empty:
+        df_formatted.rename(columns = column_renames, inplace = True) # rename columns according to dictionary
     
     return df_formatted
 
 
-def clean_gender_column(df: pd.DataFrame) -> pd.DataFrame:
+def clean_gender_column(df: pd.DataFrame, copy: bool = True) -> pd.DataFrame:
     '''
     This function cleans the 'gender' column by homogenizeing 
     all values to either 'M' or 'F' according to its first character.
-    Unknnown values will be filled with its modal value.
+    Unknnown values will be filled with the modal value of the valid ones (missing if there are none).
     
     Inputs:
     data: input dataframe that includes a 'gender' column
+    copy: if False, df is modified in place instead of copied
     
     Outputs:
     DataFrame with a cleaned 'gender' column.
     '''
-    df1 = df.copy()
+    df1 = df.copy() if copy else df
     
     # transform to upper case & homogenize values to M or F according to first character. Unknowns -> mode
-    df1['gender'] = [x[0].upper() if type(x) == str and x[0].upper() in ['M', 'F'] else df1['gender'].mode()[0] 
-                     for x in df1['gender']]
+    gender = df1['gender']
+    if not isinstance(gender.dtype, pd.StringDtype): # string columns keep their own string dtype
+        gender = gender.astype(STRING_DTYPE)
+    if gender.dtype.storage == 'pyarrow':
+        # Arrow compute kernels on the UTF-8 buffer, no intermediate pandas Series
+        first = pc.ascii_upper(pc.utf8_slice_codeunits(pa.array(gender.array), 0, 1)) # first character upper cased
+        valid = pc.is_in(first, value_set = pa.array(['M', 'F'], type = first.type))
+        # modal value of the valid values computed once, smallest value on ties, null if there are none
+        counts = pc.value_counts(pc.filter(first, valid))
+        mode_val = pc.min(pc.filter(counts.field('values'), pc.equal(counts.field('counts'), pc.max(counts.field('counts')))))
+        df1['gender'] = pd.Series(pd.array(pc.if_else(valid, first, mode_val), dtype = gender.dtype), index = df1.index)
+    else:
+        first = gender.str.slice(0, 1).str.upper() # first character upper cased
+        valid = first.isin(['M', 'F'])
+        modes = first[valid].mode() # modal value of the valid values computed once, missing if there are none
+        df1['gender'] = first.where(valid, modes.iat[0] if len(modes) else None)
 
     return df1
 
-def clean_number_of_complains_column(df: pd.DataFrame) -> pd.DataFrame:
+def clean_number_of_complains_column(df: pd.DataFrame, copy: bool = True) -> pd.DataFrame:
     '''
     This function cleans the 'number_of_complains' column by parsing 
     the date format column and getting the value in the month position
@@ -51,105 +92,339 @@ def clean_number_of_complains_column(df: pd.DataFrame) -> pd.DataFrame:
     
     Inputs:
     data: input dataframe that includes a 'number_of_open_complaints' column
+    copy: if False, df is modified in place instead of copied
     
     Outputs:
     DataFrame with a cleaned 'number_of_open_complaints' column.
     '''
-    df1 = df.copy()
+    df1 = df.copy() if copy else df
+    if pd.api.types.is_numeric_dtype(df1['number_of_open_complaints']):
+        return df1 # already numeric, no date formatted values to parse
 
-    df1['number_of_open_complaints'] = [ str(x).split('/')[1] if (type(x) is str) and ('/' in x) else x 
-                                         for x in df1['number_of_open_complaints']]
+    complaints = df1['number_of_open_complaints']
+    if not isinstance(complaints.dtype, pd.StringDtype):
+        complaints = complaints.astype(STRING_DTYPE)
+    
+    # only date formatted values are parsed
+    if complaints.dtype.storage == 'pyarrow':
+        arrow_values = pa.array(complaints.array)
+        mask = pc.fill_null(pc.match_substring(arrow_values, '/'), False)
+        months = pc.list_element(pc.split_pattern(pc.filter(arrow_values, mask), '/', max_splits = 2), 1)
+        mask = mask.to_numpy(zero_copy_only = False)
+        months = pd.array(months, dtype = complaints.dtype)
+    else:
+        mask = complaints.str.contains('/', na = False, regex = False).to_numpy()
+        months = complaints[mask].str.split('/', n = 2).str[1].array
+    if mask.any():
+        df1.loc[mask, 'number_of_open_complaints'] = months
     
     return df1
 
 
-def clean_column_by_replacing_string(df: pd.DataFrame, column:str, replacements: list) -> pd.DataFrame:
+def clean_column_by_replacing_string(df: pd.DataFrame, column:str, replacements: list, copy: bool = True,
+                                     low_cardinality: Optional[bool] = None) -> pd.DataFrame:
     '''
     This function takes a Dataframe and replaces the strings 
     in the input replacements to the specified column.
+    Categorical columns are replaced on their categories only.
     
     Inputs:
     df: input DataFrame
     column: column to apply transformations
     replacements: list of lists with replacements 
         [[old_value1, new_value1],[old_value2, new_value2],...]
+    copy: if False, df is modified in place instead of copied
+    low_cardinality: whether the column has few distinct values (replaced once per distinct value),
+        estimated on a sample of rows if None
         
     Output:
     pandas DataFrame with the clean column
     '''
-    df1 = df.copy()
+    df1 = df.copy() if copy else df
     
-    for item in replacements:
-        df1[column] = df1[column].str.replace(item[0],item[1]) # replace items in column
+    if not replacements:
+        return df1
+    
+    if isinstance(df1[column].dtype, pd.CategoricalDtype):
+        if df1[column].cat.categories.empty:
+            return df1
+        # replace on the categories only and remap the codes, merging categories that end up equal
+        values = df1[column].cat
+        new_codes, new_categories = pd.factorize(_replace_substrings(values.categories, replacements))
+        new_codes = np.append(new_codes, -1)[values.codes] # code -1 (missing) stays missing
+        df1[column] = pd.Categorical.from_codes(new_codes, categories = new_categories, ordered = values.ordered)
+    else:
+        if low_cardinality is None:
+            low_cardinality = _is_low_cardinality(df1[column])
+        if low_cardinality:
+            # low cardinality: replace each distinct value once and look the rows up by their codes
+            codes, uniques = pd.factorize(df1[column])
+            new_uniques = _replace_substrings(pd.Series(uniques, dtype = df1[column].dtype), replacements).array
+            df1[column] = pd.Series(new_uniques.take(codes, allow_fill = True), index = df1.index, dtype = new_uniques.dtype)
+        else:
+            df1[column] = _replace_substrings(df1[column], replacements) # replace items in column
         
     return df1
 
+
+def _is_low_cardinality(values: pd.Series) -> bool:
+    '''
+    Estimates on a sample of rows whether at most one value out of two is distinct.
+    '''
+    if len(values) > CARDINALITY_SAMPLE_ROWS:
+        values = values.iloc[::len(values) // CARDINALITY_SAMPLE_ROWS] # strided positional sample, O(sample size)
+    return values.nunique() <= len(values) // 2
+
+
+def _replace_substrings(values, replacements: list):
+    '''
+    Replaces the strings in replacements one after another, in order, in a Series or Index of strings.
+    '''
+    if getattr(values.dtype, 'storage', None) == 'pyarrow':
+        n_chunks = os.cpu_count() or 1
+        if isinstance(values, pd.Series) and n_chunks > 1 and len(values) >= PARALLEL_MIN_ROWS:
+            # Arrow kernels release the GIL, so contiguous chunks are replaced in parallel threads (one pool per call)
+            bounds = np.linspace(0, len(values), n_chunks + 1, dtype = int)
+            chunks = [values.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+            with ThreadPoolExecutor(max_workers = n_chunks) as executor:
+                return pd.concat(executor.map(partial(_replace_arrow_substrings, replacements = replacements), chunks))
+        return _replace_arrow_substrings(values, replacements)
+    
+    for old, new in replacements:
+        values = values.str.replace(old, new, regex = False)
+    return values
+
+
+def _replace_arrow_substrings(values, replacements: list):
+    '''
+    Serial version of _replace_substrings for Arrow backed strings.
+    '''
+    # chain literal replacements directly on the Arrow array
+    arrow_values = pa.array(values.array)
+    for old, new in replacements:
+        arrow_values = pc.replace_substring(arrow_values, pattern = old, replacement = new)
+    new_values = pd.array(arrow_values, dtype = values.dtype)
+    if isinstance(values, pd.Index):
+        return pd.Index(new_values, name = values.name)
+    return pd.Series(new_values, index = values.index, name = values.name)
+
+def convert_column_data_type(df: pd.DataFrame, column: str, dtype = 'category', copy: bool = True) -> pd.DataFrame:
+    '''
+    This function converts the specified column to the specified data type.
+    
+    Inputs:
+    df: input DataFrame
+    column: column to convert
+    dtype: data type to convert to (category by default)
+    copy: if False, df is modified in place instead of copied
+    
+    Output:
+    pandas DataFrame with the converted column
+    '''
+    df1 = df.copy() if copy else df
+    
+    df1[column] = df1[column].astype(dtype)
+    
+    return df1
+
 def reassign_column_data_type(df: pd.DataFrame, columns: Dict[str, str]) -> pd.DataFrame:
     '''
     This function takes a DataFrame and reassigns data types as specified in the columns parameter.
     
     Input: 
     df: pandas DataFrame
-    columns: Dictionary with column and data type assignment
+    columns: Dictionary with column and data type assignment.
+        'auto' parses the column as numeric (unparsable values become NaN) and downcasts
+        integer values to the smallest integer type.
     
     Output:
     Dataframe with data type reassign columns
     '''
+    auto_columns = [key for key, value in columns.items() if value == 'auto']
     
-    for key, value in columns.items():
-        df[key] = df[key].astype(value)
-
-    return df
+    df1 = df.astype({key: value for key, value in columns.items() if value != 'auto'}) # single astype call for all the columns
+    for key in auto_columns:
+        df1[key] = pd.to_numeric(df1[key], errors = 'coerce', downcast = 'integer') # smallest integer type, floats stay float64
+    
+    return df1
 
 
-def remove_duplicate_and_empty_rows(df: pd.DataFrame) -> pd.DataFrame:
+def remove_duplicate_and_empty_rows(df: pd.DataFrame, how: str = 'all') -> pd.DataFrame:
     '''
     This function removes duplicate rows and rows with all the columns empty.
     
     Input:
     df: input DataFrame
+    how: 'all' drops rows with all the columns empty, 'any' drops rows with any empty column
     
     Output:
-    df: output DataFrame
+    df: output DataFrame (always a new DataFrame)
     '''
-    df1 = df.copy()
+    if how not in ('all', 'any'):
+        raise ValueError(f"invalid how option: {how}, expected 'all' or 'any'")
     
-    df1.drop_duplicates(inplace = True) # drop all duplicate rows
-    df1.dropna(inplace = True) # drop all empty rows
+    keep = ~df.duplicated(keep = 'first') # drop all duplicate rows
+    if how == 'all':
+        keep &= df.notna().any(axis = 1) # drop all empty rows
+    else:
+        keep &= df.notna().all(axis = 1) # drop rows with any empty value
     
-    return df1
+    return df.take(np.flatnonzero(keep.to_numpy()))
+
+
+def hash_cleaning_inputs(df: pd.DataFrame, *params) -> str:
+    '''
+    This function computes a hash of a DataFrame (values, index, column names and data types),
+    of the cleaning parameters and of CACHE_VERSION, used as key to cache cleaned data.
+    
+    Inputs:
+    df: input DataFrame
+    params: cleaning parameters, values JSON cannot serialize (e.g. dtype objects) are hashed by their repr
+    
+    Output:
+    hexadecimal hash string
+    '''
+    digest = hashlib.blake2b(digest_size = 16)
+    digest.update(pd.util.hash_pandas_object(df, index = True).to_numpy().tobytes())
+    digest.update(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes)), params, CACHE_VERSION], sort_keys = True, default = repr).encode())
+    
+    return digest.hexdigest()
+
+
+def read_cached_data(path: Path) -> pd.DataFrame:
+    '''
+    This function reads a DataFrame written by write_cached_data, with its original string dtypes.
+    
+    Input:
+    path: Parquet file path
+    
+    Output:
+    cached DataFrame
+    '''
+    table = pq.read_table(path)
+    df = table.to_pandas()
+    
+    for position, spec in enumerate(json.loads(table.schema.metadata[b'string_dtypes'])):
+        if spec is None:
+            continue
+        storage, na_is_pd_na = spec
+        dtype = pd.StringDtype(storage) if na_is_pd_na or storage == 'pyarrow_numpy' else pd.StringDtype(storage, na_value = np.nan)
+        values = df.iloc[:, position]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = pd.CategoricalDtype(values.cat.categories.astype(dtype), ordered = values.cat.ordered)
+            df.isetitem(position, pd.Categorical.from_codes(values.cat.codes, dtype = categories))
+        else:
+            df.isetitem(position, values.astype(dtype))
+    
+    return df
+
+
+def write_cached_data(df: pd.DataFrame, path: Path) -> bool:
+    '''
+    This function writes a DataFrame to a Parquet file, together with the string dtypes Parquet does not keep.
+    The file is written to a temporary file and then moved into place, so readers never see a partial file.
+    
+    Input:
+    df: DataFrame to cache (not written if it has duplicate column labels, which Parquet does not support)
+    path: Parquet file path
+    
+    Output:
+    True if the file was written
+    '''
+    if not df.columns.is_unique:
+        return False
+    
+    def string_spec(dtype): # [storage, missing value is pd.NA] of string columns and string categories
+        if isinstance(dtype, pd.CategoricalDtype):
+            return string_spec(dtype.categories.dtype)
+        if isinstance(dtype, pd.StringDtype):
+            return [dtype.storage, dtype.na_value is pd.NA]
+        return None
+    
+    table = pa.Table.from_pandas(df)
+    specs = json.dumps([string_spec(dtype) for dtype in df.dtypes]).encode()
+    table = table.replace_schema_metadata({**table.schema.metadata, b'string_dtypes': specs})
+    
+    path.parent.mkdir(parents = True, exist_ok = True)
+    fd, tmp_path = tempfile.mkstemp(dir = path.parent, suffix = '.tmp')
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    
+    return True
 
 
 def clean_and_format_data(df: pd.DataFrame, 
                           cols_to_rename: Dict[str, str], 
                           cols_to_replace: Dict[str, list],
-                          cols_to_reassign_datatype: Dict[str,str]) -> pd.DataFrame:
+                          cols_to_reassign_datatype: Dict[str,str],
+                          cache_dir: Optional[str] = None) -> pd.DataFrame:
     '''
     This function executes all the cleaning functions on the input df in 4 steps:
-    (1) formats and renames column names
-    (2) removes duplicate and empty rows
-    (3) cleans the gender column
-    (4) cleans number_of_complaints column
-    (5) applies character replacements
-    (6) reassigns data types
+    (1) removes duplicate and empty rows
+    (2) formats and renames column names
+    (3) cleans each column in a single pass over the columns:
+        gender column, number_of_complaints column and character replacements
+    (4) reassigns data types
     
     Inputs:
     df: input Dataframe
     cols_to_rename: Dictionary with columns to rename
     cols_to_replace: Dictionary with columns to apply replacements
     cols_to_reassign_datatype: Dictionary with columns to reassign datatype
+    cache_dir: optional directory where results are stored as Parquet files (requires pyarrow),
+        keyed by a hash of the inputs, so repeated calls on the same data are read from disk
     
     Output:
     pandas DataFrame with clean and formatted data
     '''
-    df1 = df.copy()
+    if cache_dir is not None:
+        if PYARROW_VERSION is None:
+            raise ImportError('cache_dir requires pyarrow to read and write Parquet files')
+        cache_path = Path(cache_dir) / f'{hash_cleaning_inputs(df, cols_to_rename, cols_to_replace, cols_to_reassign_datatype)}.parquet'
+        if cache_path.exists():
+            return read_cached_data(cache_path)
+    
+    df1 = remove_duplicate_and_empty_rows(df, how = 'any')# remove duplicate and incomplete rows (the only copy of df)
+    df1 = format_columns(df1, cols_to_rename, copy = False)# format & rename columns
+    df1 = df1.astype({key: STRING_DTYPE for key, value in df1.dtypes.items() if value == object})# object columns to string dtype
     
-    df1 = format_columns(df1,cols_to_rename)# format & rename columns
-    df1 = remove_duplicate_and_empty_rows(df1)# remove duplicate and empty rows
-    df1 = clean_gender_column(df1)# clean gender column
-    df1 = clean_number_of_complains_column(df1)# clean number_of_complain_column
+    # cleaning plan: column -> cleaning steps applied to that column
+    column_steps = {'gender': [clean_gender_column],
+                    'number_of_open_complaints': [clean_number_of_complains_column]}
     for key, value in cols_to_replace.items():
-        df1 = clean_column_by_replacing_string(df1, key, value)# replace cleaning
+        low_cardinality = _is_low_cardinality(df1[key]) # estimated once per column
+        steps = column_steps.setdefault(key, [])
+        if low_cardinality: # low cardinality columns are replaced on their categories, then converted back
+            steps.append(partial(convert_column_data_type, column = key, dtype = 'category'))
+        steps.append(partial(clean_column_by_replacing_string, column = key, replacements = value,
+                             low_cardinality = low_cardinality))
+        if low_cardinality:
+            steps.append(partial(convert_column_data_type, column = key, dtype = df1[key].dtype))
+    
+    missing_columns = [column for column in column_steps if column not in df1.columns]
+    if missing_columns:
+        raise KeyError(f'columns not found: {missing_columns}')
+    
+    # clean each column on its own and build the DataFrame once, by position so duplicate column labels are kept
+    cleaned_columns = []
+    for position, column in enumerate(df1.columns):
+        values = df1.iloc[:, position]
+        if column in column_steps:
+            column_df = values.to_frame()
+            for step in column_steps[column]:
+                column_df = step(column_df, copy = False)# clean column in place
+            values = column_df.iloc[:, 0]
+        cleaned_columns.append(values)
+    df1 = pd.concat(cleaned_columns, axis = 1)
+    
     df1 = reassign_column_data_type(df1, cols_to_reassign_datatype)# reassign data types
+    
+    if cache_dir is not None:
+        write_cached_data(df1, cache_path)
         
     return df1